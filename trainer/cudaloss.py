@@ -0,0 +1,178 @@
+import torch
+from torch import autograd
+import cupy as cp
+import numpy as np
+
+from cudasparse import torch_stream
+
+
+_NUM_THREADS = 256
+
+_wdl_mse_forward_kernel = None
+
+
+def make_wdl_mse_forward_kernel():
+    global _wdl_mse_forward_kernel
+    if _wdl_mse_forward_kernel is None:
+        kernel = cp.RawKernel(
+            r"""
+typedef unsigned int uint32_t;
+extern "C" __global__
+/*
+    @assumptions:
+        The blocks must have dimensionality (ceil(size / {num_threads}),)
+        The threads must have dimensionality ({num_threads},)
+    @param: prediction
+        The network output of shape (size,), in [0, 1].
+    @param: cp
+        The centipawn evaluations of shape (size,).
+    @param: wdl_target
+        The game results of shape (size,), in [0, 1].
+    @param: diff
+        An output vector of shape (size,) receiving
+        prediction - target for the backward pass.
+    @param: loss
+        A single float that must be zero initialized.
+        The mean squared error is accumulated into it.
+    @param: inv_scale
+        The reciprocal of the centipawn to win probability scale.
+    @param: wdl
+        The weight of the game result in the target.
+    @param: size
+        The number of positions in the batch.
+*/
+void wdl_mse_forward(
+    const float*   const prediction,
+    const float*   const cp,
+    const float*   const wdl_target,
+          float*   const diff,
+          float*   const loss,
+    const float          inv_scale,
+    const float          wdl,
+    const uint32_t       size
+) {{
+    __shared__
+          float          shared_loss[{num_threads}];
+    const uint32_t       i                   = blockIdx.x * {num_threads} + threadIdx.x;
+          float          squared             = 0.0f;
+    if (i < size)
+    {{
+        const float eval_target = 1.0f / (1.0f + expf(-cp[i] * inv_scale));
+        const float target      = eval_target * (1.0f - wdl) + wdl_target[i] * wdl;
+        const float d           = prediction[i] - target;
+        diff[i] = d;
+        squared = d * d;
+    }}
+    shared_loss[threadIdx.x] = squared;
+    __syncthreads();
+    for (uint32_t s = {num_threads} / 2; s > 0; s >>= 1)
+    {{
+        if (threadIdx.x < s)
+        {{
+            shared_loss[threadIdx.x] += shared_loss[threadIdx.x + s];
+        }}
+        __syncthreads();
+    }}
+    if (threadIdx.x == 0)
+    {{
+        atomicAdd(loss, shared_loss[0] / size);
+    }}
+}}
+""".format(
+                num_threads=_NUM_THREADS,
+            ),
+            "wdl_mse_forward",
+        )
+        kernel.compile()
+        _wdl_mse_forward_kernel = kernel
+    return _wdl_mse_forward_kernel
+
+
+class WdlMseLossFunction(autograd.Function):
+    @staticmethod
+    def forward(ctx, prediction, cp_eval, wdl_target, inv_scale, wdl):
+        assert prediction.shape == cp_eval.shape == wdl_target.shape
+        assert prediction.dtype == torch.float32
+        assert cp_eval.dtype == torch.float32
+        assert wdl_target.dtype == torch.float32
+
+        assert prediction.is_cuda
+        assert cp_eval.device == prediction.device
+        assert wdl_target.device == prediction.device
+
+        assert prediction.is_contiguous()
+        assert cp_eval.is_contiguous()
+        assert wdl_target.is_contiguous()
+
+        device = prediction.device
+        size = prediction.numel()
+
+        diff = torch.empty_like(prediction)
+        loss = torch.zeros((), dtype=torch.float32, device=device)
+
+        kernel = make_wdl_mse_forward_kernel()
+        with torch_stream():
+            kernel(
+                grid=((size + _NUM_THREADS - 1) // _NUM_THREADS,),
+                block=(_NUM_THREADS,),
+                args=(
+                    prediction.data_ptr(),
+                    cp_eval.data_ptr(),
+                    wdl_target.data_ptr(),
+                    diff.data_ptr(),
+                    loss.data_ptr(),
+                    np.float32(inv_scale),
+                    np.float32(wdl),
+                    np.uint32(size),
+                ),
+            )
+
+        ctx.save_for_backward(diff)
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        assert not ctx.needs_input_grad[1]
+        assert not ctx.needs_input_grad[2]
+
+        (diff,) = ctx.saved_tensors
+        grad_prediction = diff * (grad_output * 2 / diff.numel())
+
+        return grad_prediction, None, None, None, None
+
+
+def wdl_mse_loss(prediction, cp_eval, wdl_target, inv_scale, wdl):
+    return WdlMseLossFunction.apply(
+        prediction.contiguous(), cp_eval, wdl_target, inv_scale, wdl
+    )
+
+
+if __name__ == "__main__":
+
+    def test():
+        BATCH_SIZE = 1000
+        INV_SCALE = 1 / 400
+        WDL = 0.3
+        MAX_ERROR = 1e-5
+
+        torch.manual_seed(0)
+        prediction0 = torch.rand(BATCH_SIZE, 1, requires_grad=True)
+        prediction1 = prediction0.detach().cuda().requires_grad_()
+        cp_eval = (torch.rand(BATCH_SIZE, 1) - 0.5) * 2000
+        wdl_target = torch.randint(0, 3, (BATCH_SIZE, 1)).float() / 2
+
+        expected = torch.sigmoid(cp_eval * INV_SCALE) * (1 - WDL) + wdl_target * WDL
+        loss0 = torch.mean((prediction0 - expected) ** 2)
+        loss1 = wdl_mse_loss(
+            prediction1, cp_eval.cuda(), wdl_target.cuda(), INV_SCALE, WDL
+        )
+
+        assert abs(loss0.item() - loss1.item()) < MAX_ERROR
+        loss0.backward()
+        loss1.backward()
+        assert (
+            torch.max(torch.abs(prediction0.grad - prediction1.grad.cpu())) < MAX_ERROR
+        )
+        print("Tests passed.")
+
+    test()
@@ -40,9 +40,17 @@ def _get_num_threads_for_backward(output_size):
     return _num_threads_backward_cache[output_size]
 
 
+def torch_stream():
+    # Launch on PyTorch's current stream rather than cupy's, so the kernels
+    # are ordered with the surrounding torch ops and can be captured into
+    # CUDA graphs.
+    return cp.cuda.ExternalStream(torch.cuda.current_stream().cuda_stream)
+
+
 def _kernel_with_threads(kernel, threads):
     def f(grid, args):
-        kernel(grid=grid, block=threads, args=args)
+        with torch_stream():
+            kernel(grid=grid, block=threads, args=args)
 
     return f
 
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import IntEnum
+from typing import Callable
 
 import ctypes
 import os
@@ -62,6 +64,57 @@ class Batch:
     cp: torch.Tensor
     wdl: torch.Tensor
     size: int
+    # CSR row offsets into the indices, only set for the sparse feature sets.
+    offsets: torch.Tensor | None = None
+    # Recorded on the copy stream once an asynchronous transfer has finished.
+    ready: torch.cuda.Event | None = None
+
+    def _apply(self, fn: Callable[[torch.Tensor], torch.Tensor]) -> Batch:
+        return Batch(
+            fn(self.stm_indices),
+            fn(self.nstm_indices),
+            fn(self.values),
+            fn(self.cp),
+            fn(self.wdl),
+            self.size,
+            None if self.offsets is None else fn(self.offsets),
+        )
+
+    def pin_memory(self) -> Batch:
+        return self._apply(torch.Tensor.pin_memory)
+
+    def to(
+        self, device: torch.device, non_blocking: bool = False, copy: bool = False
+    ) -> Batch:
+        return self._apply(
+            lambda tensor: tensor.to(device, non_blocking=non_blocking, copy=copy)
+        )
+
+    def record_stream(self, stream: torch.cuda.Stream) -> None:
+        for tensor in self._tensors():
+            tensor.record_stream(stream)
+
+    def _tensors(self) -> list[torch.Tensor]:
+        tensors = [self.stm_indices, self.nstm_indices, self.values, self.cp, self.wdl]
+        if self.offsets is not None:
+            tensors.append(self.offsets)
+        return tensors
+
+    def same_shape(self, other: Batch) -> bool:
+        return [tensor.shape for tensor in self._tensors()] == [
+            tensor.shape for tensor in other._tensors()
+        ]
+
+    def copy_(self, other: Batch) -> None:
+        assert self.same_shape(other)
+        for dst, src in zip(self._tensors(), other._tensors()):
+            dst.copy_(src)
+
+    def wait_ready(self, stream: torch.cuda.Stream) -> None:
+        if self.ready is not None:
+            stream.wait_event(self.ready)
+            self.record_stream(stream)
+            self.ready = None
 
 
 class ParserBatch:
@@ -116,38 +169,55 @@ class ParserBatch:
     def get_wdl_ptr(self) -> ctypes.pointer[ctypes.c_float]:
         return PARSE_LIB.batch_get_wdl_ptr(self._ptr)
 
-    def to_pytorch_batch(self, device: torch.device) -> Batch:
+    def to_pytorch_batch(self) -> Batch:
+        # Some of these CPU tensors alias the parser's buffers, so they are
+        # only valid until the next batch is read into them.
         def to_pytorch(array: np.ndarray) -> torch.Tensor:
-            tch_array = torch.from_numpy(array)
-            if torch.cuda.is_available():
-                tch_array = tch_array.pin_memory()
-            return tch_array.to(device, non_blocking=True)
+            return torch.from_numpy(array)
 
+        batch_len = self.get_len()
         total_features = self.get_total_features()
         indices_per_feature = self.get_indices_per_feature()
-        boards_stm = to_pytorch(
-            np.ctypeslib.as_array(
-                self.get_stm_feature_buffer_ptr(),
-                shape=(total_features * indices_per_feature,),
-            )
-        )
-        boards_nstm = to_pytorch(
-            np.ctypeslib.as_array(
-                self.get_nstm_feature_buffer_ptr(),
-                shape=(total_features * indices_per_feature,),
-            )
+        stm_features = np.ctypeslib.as_array(
+            self.get_stm_feature_buffer_ptr(),
+            shape=(total_features, indices_per_feature),
         )
-        values = to_pytorch(
-            np.ctypeslib.as_array(self.get_values_ptr(), shape=(total_features,))
+        nstm_features = np.ctypeslib.as_array(
+            self.get_nstm_feature_buffer_ptr(),
+            shape=(total_features, indices_per_feature),
         )
+        values = np.ctypeslib.as_array(self.get_values_ptr(), shape=(total_features,))
+
+        offsets = None
+        if indices_per_feature == 2:
+            # Sparse feature sets store (row, column) pairs with rows in
+            # ascending order, so the rows collapse into CSR row offsets.
+            row_offsets = np.zeros(batch_len + 1, dtype=np.int64)
+            np.cumsum(
+                np.bincount(stm_features[:, 0], minlength=batch_len),
+                out=row_offsets[1:],
+            )
+            offsets = to_pytorch(row_offsets)
+            boards_stm = to_pytorch(np.ascontiguousarray(stm_features[:, 1]))
+            boards_nstm = to_pytorch(np.ascontiguousarray(nstm_features[:, 1]))
+        else:
+            # CUDA feature sets store max_features slots per entry, which the
+            # kernels take as int32.
+            boards_stm = to_pytorch(
+                stm_features.reshape(batch_len, -1).astype(np.int32)
+            )
+            boards_nstm = to_pytorch(
+                nstm_features.reshape(batch_len, -1).astype(np.int32)
+            )
+            values = values.reshape(batch_len, -1)
+        values = to_pytorch(values)
 
-        batch_len = self.get_len()
         cp = to_pytorch(np.ctypeslib.as_array(self.get_cp_ptr(), shape=(batch_len, 1)))
         wdl = to_pytorch(
             np.ctypeslib.as_array(self.get_wdl_ptr(), shape=(batch_len, 1))
         )
 
-        return Batch(boards_stm, boards_nstm, values, cp, wdl, batch_len)
+        return Batch(boards_stm, boards_nstm, values, cp, wdl, batch_len, offsets)
 
 
 class ParserFileReader:
@@ -188,15 +258,42 @@ class BatchLoader:
         self._batch = ParserBatch(
             batch_size, feature_set.max_features(), feature_set.indices_per_feature()
         )
+        self._copy_stream: torch.cuda.Stream | None = None
 
-    def read_batch(self, device: torch.device) -> tuple[bool, Batch]:
+    def read_batch(
+        self, device: torch.device, synchronize: bool = True
+    ) -> tuple[bool, Batch]:
+        """Read the next batch onto `device`.
+
+        With `synchronize=False` a CUDA batch is returned while its copy may
+        still be in flight, and `Batch.wait_ready` must be called on the
+        consuming stream before it is used.
+        """
         new_epoch = False
         while not read_batch_into(self._reader, self._feature_set, self._batch):
             self._reader.drop()
             self._file_index = (self._file_index + 1) % len(self._files)
             self._reader = ParserFileReader(self._files[self._file_index])
             new_epoch = self._file_index == 0
-        return new_epoch, self._batch.to_pytorch_batch(device)
+        batch = self._batch.to_pytorch_batch()
+        if device.type != "cuda":
+            # Copy out of the parser's buffers, which the next read reuses.
+            return new_epoch, batch.to(device, copy=True)
+
+        # Stage through page-locked memory so the copy can run asynchronously
+        # on a side stream, overlapping with work already queued on the
+        # compute stream. The caching host allocator recycles the pinned
+        # blocks and keeps them alive until the copy has completed.
+        if self._copy_stream is None:
+            self._copy_stream = torch.cuda.Stream(device)
+        batch = batch.pin_memory()
+        with torch.cuda.stream(self._copy_stream):
+            batch = batch.to(device, non_blocking=True)
+            batch.ready = torch.cuda.Event()
+            batch.ready.record()
+        if synchronize:
+            batch.wait_ready(torch.cuda.current_stream(device))
+        return new_epoch, batch
 
     def drop(self) -> None:
         self._reader.drop()
@@ -207,3 +304,41 @@ class BatchLoader:
 
     def __exit__(self) -> None:
         self.drop()
+
+
+class Prefetcher:
+    """Reads the next batch on a background thread while the current one trains."""
+
+    def __init__(self, loader: BatchLoader, device: torch.device) -> None:
+        self._loader = loader
+        self._device = device
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._next = self._read_next()
+
+    def _read_next(self) -> Future[tuple[bool, Batch]]:
+        return self._executor.submit(
+            self._loader.read_batch, self._device, synchronize=False
+        )
+
+    def __iter__(self) -> Prefetcher:
+        return self
+
+    def __next__(self) -> tuple[bool, Batch]:
+        new_epoch, batch = self._next.result()
+        self._next = self._read_next()
+        if self._device.type == "cuda":
+            batch.wait_ready(torch.cuda.current_stream(self._device))
+        return new_epoch, batch
+
+    def wait(self) -> None:
+        """Blocks until the background read has finished."""
+        self._next.result()
+
+    def drop(self) -> None:
+        self._executor.shutdown()
+
+    def __enter__(self) -> Prefetcher:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.drop()
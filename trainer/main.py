@@ -4,8 +4,10 @@ import argparse
 import json
 import os
 import pathlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
 
-from dataloader import BatchLoader
+from dataloader import Batch, BatchLoader, Prefetcher
 from model import (
     NnBoard768Cuda,
     NnBoard768,
@@ -13,10 +15,15 @@ from model import (
     NnHalfKACuda,
     NnHalfKP,
     NnHalfKPCuda,
+    SquaredNnBoard768Cuda,
+    enable_qat,
+    export_parameters,
 )
 from time import time
 
+import numpy as np
 import torch
+from torch.nn.utils import parametrize
 from trainlog import TrainLog
 
 DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -24,15 +31,139 @@ DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 LOG_ITERS = 10_000_000
 
 
-class WeightClipper:
-    def __init__(self, frequency=1):
-        self.frequency = frequency
+def _unparametrized_weight(module: torch.nn.Module) -> torch.Tensor:
+    # Under QAT the optimizer updates the original tensor behind the
+    # fake-quantize parametrization, so that is the one to clamp.
+    if parametrize.is_parametrized(module, "weight"):
+        return module.parametrizations.weight.original
+    return module.weight
+
+
+class ClippedAdam(torch.optim.Adam):
+    """Adam that clamps the feature transformer weights after every update.
+
+    Only the feature transformer has to stay within the quantized range
+    used for inference, so the output layer and biases are left alone.
+    """
+
+    def __init__(self, model: torch.nn.Module, limit: float = 1.98, **kwargs):
+        super().__init__(model.parameters(), **kwargs)
+        self.limit = limit
+        self.clipped = [
+            _unparametrized_weight(module)
+            for module in (getattr(model, "ft", None), getattr(model, "fft", None))
+            if module is not None
+        ]
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = super().step(closure)
+        if not self.clipped:
+            return loss
+        if hasattr(torch, "_foreach_clamp_min_"):
+            torch._foreach_clamp_min_(self.clipped, -self.limit)
+            torch._foreach_clamp_max_(self.clipped, self.limit)
+        else:
+            for weight in self.clipped:
+                weight.clamp_(-self.limit, self.limit)
+        return loss
+
+
+class CudaGraphStep:
+    """Replays a training step from a CUDA graph once its shapes are known.
+
+    The first few calls run eagerly on a side stream so lazy initialization
+    (optimizer state, kernel compilation, cuBLAS handles) happens outside
+    the capture. Batches with other shapes, like the short batch at the end
+    of a file, run eagerly. `before_capture` is called ahead of every capture
+    to wait out CUDA work on other threads, which would invalidate it.
+    """
+
+    def __init__(
+        self,
+        step: Callable[[Batch], torch.Tensor],
+        warmup_steps: int = 3,
+        before_capture: Callable[[], None] | None = None,
+    ):
+        self._step = step
+        self._warmup_steps = warmup_steps
+        self._before_capture = before_capture
+        self._graph: torch.cuda.CUDAGraph | None = None
+        self._static_batch: Batch | None = None
+        self._static_loss: torch.Tensor | None = None
+
+    def reset(self) -> None:
+        # Scalars like the learning rate are baked into the captured kernels,
+        # so the graph has to be recaptured when they change.
+        self._graph = None
+
+    def __call__(self, batch: Batch) -> torch.Tensor:
+        if self._warmup_steps > 0:
+            self._warmup_steps -= 1
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                loss = self._step(batch)
+            torch.cuda.current_stream().wait_stream(side_stream)
+            return loss
+
+        if self._graph is None:
+            if self._before_capture is not None:
+                self._before_capture()
+            self._static_batch = batch.to(DEVICE, copy=True)
+            self._graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self._graph):
+                self._static_loss = self._step(self._static_batch)
+        elif self._static_batch.same_shape(batch):
+            self._static_batch.copy_(batch)
+        else:
+            return self._step(batch)
+
+        self._graph.replay()
+        return self._static_loss
+
+
+def _wdl_mse_loss(
+    prediction: torch.Tensor,
+    cp: torch.Tensor,
+    wdl_target: torch.Tensor,
+    inv_scale: float,
+    wdl: float,
+) -> torch.Tensor:
+    # lerp blends eval and result in one pass: eval * (1 - wdl) + result * wdl.
+    expected = torch.lerp(torch.sigmoid(cp * inv_scale), wdl_target, wdl)
+    return torch.mean((prediction - expected) ** 2)
+
+
+def _report_loss(
+    loss: torch.Tensor, positions: int, train_log: TrainLog | None
+) -> None:
+    # Runs on the logging thread, so the .item() sync does not stall the
+    # training loop.
+    running_loss = loss.item()
+    print(
+        f"At {positions} positions",
+        f"Running Loss: {running_loss}",
+        sep=os.linesep,
+    )
+    if train_log is not None:
+        train_log.update(running_loss)
+        train_log.save()
+
 
-    def __call__(self, module):
-        if hasattr(module, "weight"):
-            w = module.weight.data
-            w = w.clamp(-1.98, 1.98)
-            module.weight.data = w
+def _write_checkpoint(
+    state: dict[str, torch.Tensor],
+    params: dict[str, torch.Tensor],
+    train_id: str,
+    epoch: int,
+) -> None:
+    torch.save(state, f"nn/{train_id}_{epoch}")
+    np.savez_compressed(
+        f"nn/{train_id}.npz", **{name: param.numpy() for name, param in params.items()}
+    )
+    shapes = {name: list(param.shape) for name, param in params.items()}
+    with open(f"nn/{train_id}.shapes.json", "w") as json_file:
+        json.dump(shapes, json_file)
 
 
 def train(
@@ -46,74 +177,136 @@ def train(
     train_id: str,
     lr_drop: int | None = None,
     train_log: TrainLog | None = None,
+    cuda_graphs: bool = False,
 ) -> None:
-    clipper = WeightClipper()
+    inv_scale = 1.0 / scale
+
+    loss_fn = _wdl_mse_loss
+    if DEVICE.type == "cuda" and not hasattr(torch, "compile"):
+        # Without Inductor to fuse the target blend and the MSE, use the
+        # hand-fused CUDA kernel instead.
+        from cudaloss import wdl_mse_loss as loss_fn
+
+    def compute_loss(batch: Batch) -> torch.Tensor:
+        # The forward stays in fp32: the feature transformers are fp32
+        # kernels, so bf16 autocast would only reach the output layer and
+        # sigmoid, losing precision there without any tensor-core work.
+        # Under QAT, cached() fake-quantizes the weights once per forward
+        # rather than on every access, once for each perspective.
+        with parametrize.cached():
+            prediction = model(batch)
+        return loss_fn(prediction, batch.cp, batch.wdl, inv_scale, wdl)
+
+    # Older torch releases have no torch.compile, so fall back to eager there.
+    # Weight clipping happens in the optimizer step, outside the compiled
+    # region, since it rewrites parameter data in place. With manual CUDA
+    # graphs the whole step is captured below, so Inductor must not use CUDA
+    # graphs of its own.
+    if hasattr(torch, "compile"):
+        compute_loss = torch.compile(
+            compute_loss, mode=None if cuda_graphs else "reduce-overhead"
+        )
+
+    def train_step(batch: Batch) -> torch.Tensor:
+        optimizer.zero_grad(set_to_none=True)
+        loss = compute_loss(batch)
+        loss.backward()
+        optimizer.step()
+        return loss
+
+    def drain_background_work() -> None:
+        # The prefetch worker pins and allocates memory, and the logger
+        # reads the loss back to the host; neither may overlap a capture.
+        prefetcher.wait()
+        if pending_log is not None:
+            pending_log.result()
+
+    step: Callable[[Batch], torch.Tensor] = train_step
+    if cuda_graphs:
+        step = CudaGraphStep(train_step, before_capture=drain_background_work)
+
     running_loss = torch.zeros((1,), device=DEVICE)
     start_time = time()
     iterations = 0
 
     loss_since_log = torch.zeros((1,), device=DEVICE)
     iter_since_log = 0
+    logger = ThreadPoolExecutor(max_workers=1)
+    pending_log: Future | None = None
+    saver = ThreadPoolExecutor(max_workers=1)
+    pending_save: Future | None = None
 
     fens = 0
     epoch = 0
 
-    while epoch < epochs:
-        new_epoch, batch = dataloader.read_batch(DEVICE)
-        if new_epoch:
-            epoch += 1
-            if epoch == lr_drop:
-                optimizer.param_groups[0]["lr"] *= 0.1
-            print(
-                f"epoch {epoch}",
-                f"epoch train loss: {running_loss.item() / iterations}",
-                f"epoch pos/s: {fens / (time() - start_time)}",
-                sep=os.linesep,
-            )
-
-            running_loss = torch.zeros((1,), device=DEVICE)
-            start_time = time()
-            iterations = 0
-            fens = 0
-
-            if epoch % save_epochs == 0:
-                torch.save(model.state_dict(), f"nn/{train_id}_{epoch}")
-                param_map = {
-                    name: param.detach().cpu().numpy().tolist()
-                    for name, param in model.named_parameters()
-                }
-                with open(f"nn/{train_id}.json", "w") as json_file:
-                    json.dump(param_map, json_file)
-
-
-        optimizer.zero_grad()
-        prediction = model(batch)
-        expected = torch.sigmoid(batch.cp / scale) * (1 - wdl) + batch.wdl * wdl
-
-        loss = torch.mean((prediction - expected) ** 2)
-        loss.backward()
-        optimizer.step()
-        model.apply(clipper)
-
-        with torch.no_grad():
-            running_loss += loss
-            loss_since_log += loss
-        iterations += 1
-        iter_since_log += 1
-        fens += batch.size
-
-        if iter_since_log * batch.size > LOG_ITERS:
-            loss = loss_since_log.item() / iter_since_log
-            print(
-                f"At {iterations * batch.size} positions",
-                f"Running Loss: {loss}",
-                sep=os.linesep,
-            )
-            if train_log is not None:
-                train_log.update(loss)
-                train_log.save()
-            iter_since_log = 0
-            loss_since_log = torch.zeros((1,), device=DEVICE)
+    with Prefetcher(dataloader, DEVICE) as prefetcher:
+        while epoch < epochs:
+            new_epoch, batch = next(prefetcher)
+            if new_epoch:
+                epoch += 1
+                if epoch == lr_drop:
+                    optimizer.param_groups[0]["lr"] *= 0.1
+                    if isinstance(step, CudaGraphStep):
+                        step.reset()
+                print(
+                    f"epoch {epoch}",
+                    f"epoch train loss: {running_loss.item() / iterations}",
+                    f"epoch pos/s: {fens / (time() - start_time)}",
+                    sep=os.linesep,
+                )
+
+                running_loss = torch.zeros((1,), device=DEVICE)
+                start_time = time()
+                iterations = 0
+                fens = 0
+
+                if epoch % save_epochs == 0:
+                    # Snapshot on this thread so later optimizer steps cannot
+                    # race the writer, then serialize in the background.
+                    with torch.no_grad():
+                        state = {
+                            name: tensor.detach().to("cpu", copy=True)
+                            for name, tensor in model.state_dict().items()
+                        }
+                        params = {
+                            name: param.detach().to("cpu", copy=True)
+                            for name, param in export_parameters(model).items()
+                        }
+                    # Re-raise any failure from the previous save on this thread.
+                    if pending_save is not None:
+                        pending_save.result()
+                    pending_save = saver.submit(
+                        _write_checkpoint, state, params, train_id, epoch
+                    )
+
+            loss = step(batch)
+
+            with torch.no_grad():
+                running_loss += loss
+                loss_since_log += loss
+            iterations += 1
+            iter_since_log += 1
+            fens += batch.size
+
+            if iter_since_log * batch.size > LOG_ITERS:
+                # Re-raise any failure from the previous report on this thread.
+                if pending_log is not None:
+                    pending_log.result()
+                pending_log = logger.submit(
+                    _report_loss,
+                    loss_since_log / iter_since_log,
+                    iterations * batch.size,
+                    train_log,
+                )
+                iter_since_log = 0
+                loss_since_log = torch.zeros((1,), device=DEVICE)
+
+    logger.shutdown()
+    if pending_log is not None:
+        pending_log.result()
+    saver.shutdown()
+    if pending_save is not None:
+        pending_save.result()
 
 
 def main():
@@ -141,20 +334,65 @@ def main():
         default=None,
         help="The epoch learning rate will be dropped",
     )
+    parser.add_argument(
+        "--board768",
+        action="store_true",
+        help="Train NnBoard768 (clipped, unsquared activations, embedding_bag "
+        "feature transformer) instead of SquaredNnBoard768Cuda",
+    )
+    parser.add_argument(
+        "--qat",
+        action="store_true",
+        help="Fake-quantize the feature transformer weights to int8 while training",
+    )
+    parser.add_argument(
+        "--cuda-graphs",
+        action="store_true",
+        help="Capture the training step into a CUDA graph and replay it",
+    )
     args = parser.parse_args()
 
+    if args.cuda_graphs and DEVICE.type != "cuda":
+        parser.error("--cuda-graphs requires a CUDA device")
+    if args.cuda_graphs and args.qat:
+        # The fake-quantize observer reads device values on the host every
+        # step, which is not allowed while a graph is being captured.
+        parser.error("--cuda-graphs cannot be combined with --qat")
+    if args.cuda_graphs and args.board768:
+        # Every sparse batch has a different number of features, so the
+        # captured graph would almost never be replayed.
+        parser.error("--cuda-graphs cannot be combined with --board768")
+
     assert args.train_id is not None
     assert args.scale is not None
 
     train_log = TrainLog(args.train_id)
 
-    model = NnHalfKPCuda(128).to(DEVICE)
+    if args.board768:
+        model = NnBoard768(128).to(DEVICE)
+    else:
+        model = SquaredNnBoard768Cuda(128).to(DEVICE)
+    if args.qat:
+        enable_qat(model)
 
     data_path = pathlib.Path(args.data_root)
     paths = list(map(str, data_path.glob("*.bin")))
     dataloader = BatchLoader(paths, model.input_feature_set(), args.batch_size)
 
-    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    # The fused CUDA kernel updates every parameter in one launch; builds
+    # without it (torch < 1.13) fall back to the multi-tensor foreach path.
+    # Graph capture needs the optimizer to keep its step counts on the device.
+    try:
+        optimizer = ClippedAdam(
+            model,
+            lr=args.lr,
+            fused=DEVICE.type == "cuda",
+            capturable=args.cuda_graphs,
+        )
+    except (TypeError, RuntimeError):
+        optimizer = ClippedAdam(
+            model, lr=args.lr, foreach=True, capturable=args.cuda_graphs
+        )
 
     train(
         model,
@@ -167,6 +405,7 @@ def main():
         args.train_id,
         lr_drop=args.lr_drop,
         train_log=train_log,
+        cuda_graphs=args.cuda_graphs,
     )
 
 
@@ -1,26 +1,119 @@
+import math
+
 import torch
+from torch.ao.quantization import FakeQuantize, PerChannelMinMaxObserver
+from torch.nn.utils import parametrize
 
 from dataloader import Batch, InputFeatureSet
 
 
+class SparseLinear(torch.nn.Module):
+    # Weights are stored as (inputs, outputs), matching the CUDA slices, so
+    # each active feature selects a row that is summed per position.
+    def __init__(self, num_inputs: int, num_outputs: int):
+        super().__init__()
+        self.num_inputs = num_inputs
+        self.num_outputs = num_outputs
+
+        sigma = math.sqrt(1 / num_inputs)
+        self.weight = torch.nn.Parameter(
+            torch.rand(num_inputs, num_outputs) * (2 * sigma) - sigma
+        )
+        self.bias = torch.nn.Parameter(torch.rand(num_outputs) * (2 * sigma) - sigma)
+
+    def forward(
+        self, indices: torch.Tensor, offsets: torch.Tensor, values: torch.Tensor
+    ) -> torch.Tensor:
+        return (
+            torch.nn.functional.embedding_bag(
+                indices,
+                self.weight,
+                offsets,
+                mode="sum",
+                per_sample_weights=values,
+                include_last_offset=True,
+            )
+            + self.bias
+        )
+
+
+class _FoldedFakeQuantize(torch.nn.Module):
+    # Fake-quantizes ft + fft, the weights export_parameters folds together,
+    # and returns ft's share of the result, so every bucket the forward sees
+    # is on the int8 grid.
+    def __init__(self, fake_quant: FakeQuantize, factoriser: torch.nn.Module):
+        super().__init__()
+        self.fake_quant = fake_quant
+        # Kept out of the module tree so the factoriser's parameters are not
+        # registered a second time under ft.
+        self._factoriser_weight = lambda: factoriser.weight
+
+    def forward(self, weight: torch.Tensor) -> torch.Tensor:
+        factoriser = self._factoriser_weight()
+        tiled = factoriser.repeat(weight.shape[0] // factoriser.shape[0], 1)
+        return self.fake_quant(weight + tiled) - tiled
+
+
+def enable_qat(model: torch.nn.Module) -> None:
+    """Fake-quantize the feature transformer weights to per-output int8.
+
+    For factorised nets the folded weights are quantized, as those are the
+    ones that get exported.
+    """
+    ft = model.ft
+    fake_quant = FakeQuantize(
+        observer=PerChannelMinMaxObserver,
+        quant_min=-128,
+        quant_max=127,
+        dtype=torch.qint8,
+        qscheme=torch.per_channel_symmetric,
+        # Feature transformer weights are stored as (inputs, outputs).
+        ch_axis=1,
+    ).to(ft.weight.device)
+    if hasattr(model, "fft"):
+        fake_quant = _FoldedFakeQuantize(fake_quant, model.fft)
+    parametrize.register_parametrization(ft, "weight", fake_quant)
+
+
+def export_parameters(
+    model: torch.nn.Module, limit: float = 1.98
+) -> dict[str, torch.Tensor]:
+    """Named parameters as the engine sees them.
+
+    Fake quantization is applied and the factoriser is folded into `ft`.
+    `ft` and `fft` are each clipped to `limit` while training, so their sum
+    can reach twice that and is clamped back into range.
+    """
+    params = {}
+    for name, param in model.named_parameters():
+        module_name, parametrized, tensor_name = name.partition(".parametrizations.")
+        if parametrized:
+            tensor_name = tensor_name.split(".")[0]
+            name = f"{module_name}.{tensor_name}"
+            param = getattr(model.get_submodule(module_name), tensor_name)
+        params[name] = param
+
+    # The factoriser only shares weights across king buckets while training.
+    # Feature k * fft_inputs + j sees ft[k * fft_inputs + j] + fft[j], so fold
+    # it into the bucketed weights and export a single feature transformer.
+    if hasattr(model, "fft"):
+        ft_weight = params.pop("ft.weight")
+        fft_weight = params.pop("fft.weight")
+        folded = ft_weight.view(-1, *fft_weight.shape) + fft_weight
+        params["ft.weight"] = folded.reshape(ft_weight.shape).clamp(-limit, limit)
+        params["ft.bias"] = params.pop("ft.bias") + params.pop("fft.bias")
+    return params
+
+
 class NnBoard768(torch.nn.Module):
     def __init__(self, ft_out: int):
         super().__init__()
-        self.ft = torch.nn.Linear(768, ft_out)
+        self.ft = SparseLinear(768, ft_out)
         self.out = torch.nn.Linear(ft_out * 2, 1)
 
     def forward(self, batch: Batch):
-        stm_indices = batch.stm_indices.reshape(-1, 2).T
-        nstm_indices = batch.nstm_indices.reshape(-1, 2).T
-        board_stm_sparse = torch.sparse_coo_tensor(
-            stm_indices, batch.values, (batch.size, 768)
-        ).to_dense()
-        board_nstm_sparse = torch.sparse_coo_tensor(
-            nstm_indices, batch.values, (batch.size, 768)
-        ).to_dense()
-
-        stm_ft = self.ft(board_stm_sparse)
-        nstm_ft = self.ft(board_nstm_sparse)
+        stm_ft = self.ft(batch.stm_indices, batch.offsets, batch.values)
+        nstm_ft = self.ft(batch.nstm_indices, batch.offsets, batch.values)
 
         hidden = torch.clamp(torch.cat((stm_ft, nstm_ft), dim=1), 0, 1)
 
@@ -33,37 +126,20 @@ class NnBoard768(torch.nn.Module):
 class NnHalfKP(torch.nn.Module):
     def __init__(self, ft_out: int):
         super().__init__()
-        self.ft = torch.nn.Linear(40960, ft_out)
-        self.fft = torch.nn.Linear(640, ft_out)
+        self.ft = SparseLinear(40960, ft_out)
+        self.fft = SparseLinear(640, ft_out)
         self.out = torch.nn.Linear(ft_out * 2, 1)
 
     def forward(self, batch: Batch):
+        stm_ft = self.ft(batch.stm_indices, batch.offsets, batch.values)
+        nstm_ft = self.ft(batch.nstm_indices, batch.offsets, batch.values)
+        v_stm_ft = self.fft(batch.stm_indices % 640, batch.offsets, batch.values)
+        v_nstm_ft = self.fft(batch.nstm_indices % 640, batch.offsets, batch.values)
 
-        stm_indices = batch.stm_indices.reshape(-1, 2).T
-        nstm_indices = batch.nstm_indices.reshape(-1, 2).T
-        board_stm_sparse = torch.sparse_coo_tensor(
-            stm_indices, batch.values, (batch.size, 40960)
-        )
-        board_nstm_sparse = torch.sparse_coo_tensor(
-            nstm_indices, batch.values, (batch.size, 40960)
+        hidden = torch.clamp(
+            torch.cat((stm_ft + v_stm_ft, nstm_ft + v_nstm_ft), dim=1), 0, 1
         )
 
-        v_stm_indices = torch.clone(stm_indices)
-        v_nstm_indices = torch.clone(nstm_indices)
-        v_stm_indices[1][:] %= 640
-        v_nstm_indices[1][:] %= 640
-        v_board_stm_sparse = torch.sparse_coo_tensor(
-            v_stm_indices, batch.values, (batch.size, 640)
-        ).to_dense()
-        v_board_nstm_sparse = torch.sparse_coo_tensor(
-            v_nstm_indices, batch.values, (batch.size, 640)
-        ).to_dense()
-
-        stm_ft = self.ft(board_stm_sparse) + self.fft(v_board_stm_sparse)
-        nstm_ft = self.ft(board_nstm_sparse) + self.fft(v_board_nstm_sparse)
-
-        hidden = torch.clamp(torch.cat((stm_ft, nstm_ft), dim=1), 0, 1)
-
         return torch.sigmoid(self.out(hidden))
 
     def input_feature_set(self) -> InputFeatureSet:
@@ -73,67 +149,71 @@ class NnHalfKP(torch.nn.Module):
 class NnHalfKA(torch.nn.Module):
     def __init__(self, ft_out: int):
         super().__init__()
-        self.ft = torch.nn.Linear(49152, ft_out)
-        self.fft = torch.nn.Linear(768, ft_out)
+        self.ft = SparseLinear(49152, ft_out)
+        self.fft = SparseLinear(768, ft_out)
         self.out = torch.nn.Linear(ft_out * 2, 1)
 
     def forward(self, batch: Batch):
-        stm_indices = batch.stm_indices.reshape(-1, 2).T
-        nstm_indices = batch.nstm_indices.reshape(-1, 2).T
-        board_stm_sparse = torch.sparse_coo_tensor(
-            stm_indices, batch.values, (batch.size, 49152)
-        )
-        board_nstm_sparse = torch.sparse_coo_tensor(
-            nstm_indices, batch.values, (batch.size, 49152)
+        stm_ft = self.ft(batch.stm_indices, batch.offsets, batch.values)
+        nstm_ft = self.ft(batch.nstm_indices, batch.offsets, batch.values)
+        v_stm_ft = self.fft(batch.stm_indices % 768, batch.offsets, batch.values)
+        v_nstm_ft = self.fft(batch.nstm_indices % 768, batch.offsets, batch.values)
+
+        hidden = torch.clamp(
+            torch.cat((stm_ft + v_stm_ft, nstm_ft + v_nstm_ft), dim=1), 0, 1
         )
 
-        v_stm_indices = torch.clone(stm_indices)
-        v_nstm_indices = torch.clone(nstm_indices)
-        v_stm_indices[1][:] %= 768
-        v_nstm_indices[1][:] %= 768
-        v_board_stm_sparse = torch.sparse_coo_tensor(
-            v_stm_indices, batch.values, (batch.size, 768)
-        ).to_dense()
-        v_board_nstm_sparse = torch.sparse_coo_tensor(
-            v_nstm_indices, batch.values, (batch.size, 768)
-        ).to_dense()
+        return torch.sigmoid(self.out(hidden))
 
-        stm_ft = self.ft(board_stm_sparse) + self.fft(v_board_stm_sparse)
-        nstm_ft = self.ft(board_nstm_sparse) + self.fft(v_board_nstm_sparse)
+    def input_feature_set(self) -> InputFeatureSet:
+        return InputFeatureSet.HALF_KA
+
+
+class NnBoard768Cuda(torch.nn.Module):
+    def __init__(self, ft_out: int):
+        from cudasparse import DoubleFeatureTransformerSlice
+
+        super().__init__()
+        self.ft = DoubleFeatureTransformerSlice(768, ft_out)
+        self.out = torch.nn.Linear(ft_out * 2, 1)
+
+    def forward(self, batch: Batch):
+        stm_ft, nstm_ft = self.ft(
+            batch.stm_indices,
+            batch.values,
+            batch.nstm_indices,
+            batch.values,
+        )
 
         hidden = torch.clamp(torch.cat((stm_ft, nstm_ft), dim=1), 0, 1)
 
         return torch.sigmoid(self.out(hidden))
 
     def input_feature_set(self) -> InputFeatureSet:
-        return InputFeatureSet.HALF_KA
+        return InputFeatureSet.BOARD_768_CUDA
 
 
-class NnBoard768Cuda(torch.nn.Module):
+class SquaredNnBoard768Cuda(torch.nn.Module):
     def __init__(self, ft_out: int):
         from cudasparse import DoubleFeatureTransformerSlice
 
         super().__init__()
-        self.max_features = InputFeatureSet.BOARD_768_CUDA.max_features()
         self.ft = DoubleFeatureTransformerSlice(768, ft_out)
         self.out = torch.nn.Linear(ft_out * 2, 1)
 
     def forward(self, batch: Batch):
-        values = batch.values.reshape(-1, self.max_features)
-        stm_indices = batch.stm_indices.reshape(-1, self.max_features).type(
-            dtype=torch.int32
-        )
-        nstm_indices = batch.nstm_indices.reshape(-1, self.max_features).type(
-            dtype=torch.int32
-        )
         stm_ft, nstm_ft = self.ft(
-            stm_indices,
-            values,
-            nstm_indices,
-            values,
+            batch.stm_indices,
+            batch.values,
+            batch.nstm_indices,
+            batch.values,
         )
 
-        hidden = torch.clamp(torch.cat((stm_ft, nstm_ft), dim=1), 0, 1)
+        # Clip in place on the freshly concatenated buffer, and square into
+        # the only new activation. hardtanh_ derives its gradient from its
+        # result, so autograd does not need the unclipped values.
+        x = torch.nn.functional.hardtanh_(torch.cat((stm_ft, nstm_ft), dim=1), 0, 1)
+        hidden = x.square()
 
         return torch.sigmoid(self.out(hidden))
 
@@ -146,27 +226,22 @@ class NnHalfKPCuda(torch.nn.Module):
         super().__init__()
         from cudasparse import DoubleFeatureTransformerSlice
 
-        self.max_features = InputFeatureSet.HALF_KP_CUDA.max_features()
         self.ft = DoubleFeatureTransformerSlice(40960, ft_out)
         self.fft = DoubleFeatureTransformerSlice(640, ft_out)
         self.out = torch.nn.Linear(ft_out * 2, 1)
 
     def forward(self, batch: Batch):
-        values = batch.values.reshape(-1, self.max_features)
-        stm_indices = batch.stm_indices.reshape(-1, self.max_features).type(
-            dtype=torch.int32
-        )
-        nstm_indices = batch.nstm_indices.reshape(-1, self.max_features).type(
-            dtype=torch.int32
-        )
         stm_ft, nstm_ft = self.ft(
-            stm_indices,
-            values,
-            nstm_indices,
-            values,
+            batch.stm_indices,
+            batch.values,
+            batch.nstm_indices,
+            batch.values,
         )
         v_stm_ft, v_nstm_ft = self.fft(
-            stm_indices.fmod(640), values, nstm_indices.fmod(640), values
+            batch.stm_indices.fmod(640),
+            batch.values,
+            batch.nstm_indices.fmod(640),
+            batch.values,
         )
 
         hidden = torch.clamp(
@@ -184,27 +259,22 @@ class NnHalfKACuda(torch.nn.Module):
         super().__init__()
         from cudasparse import DoubleFeatureTransformerSlice
 
-        self.max_features = InputFeatureSet.HALF_KA_CUDA.max_features()
         self.ft = DoubleFeatureTransformerSlice(49152, ft_out)
         self.fft = DoubleFeatureTransformerSlice(768, ft_out)
         self.out = torch.nn.Linear(ft_out * 2, 1)
 
     def forward(self, batch: Batch):
-        values = batch.values.reshape(-1, self.max_features)
-        stm_indices = batch.stm_indices.reshape(-1, self.max_features).type(
-            dtype=torch.int32
-        )
-        nstm_indices = batch.nstm_indices.reshape(-1, self.max_features).type(
-            dtype=torch.int32
-        )
         stm_ft, nstm_ft = self.ft(
-            stm_indices,
-            values,
-            nstm_indices,
-            values,
+            batch.stm_indices,
+            batch.values,
+            batch.nstm_indices,
+            batch.values,
         )
         v_stm_ft, v_nstm_ft = self.fft(
-            stm_indices.fmod(768), values, nstm_indices.fmod(768), values
+            batch.stm_indices.fmod(768),
+            batch.values,
+            batch.nstm_indices.fmod(768),
+            batch.values,
         )
 
         hidden = torch.clamp(
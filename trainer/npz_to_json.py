@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+import json
+import pathlib
+import sys
+
+import numpy as np
+
+
+def convert(path: str) -> None:
+    with np.load(path) as params:
+        param_map = {name: params[name].tolist() for name in params.files}
+    with open(pathlib.Path(path).with_suffix(".json"), "w") as json_file:
+        json.dump(param_map, json_file)
+
+
+def main():
+    files = [arg for arg in sys.argv if arg.endswith(".npz")]
+    for f in files:
+        convert(f)
+
+
+if __name__ == "__main__":
+    main()